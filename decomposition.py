@@ -9,12 +9,20 @@ parallel digraphs. SIAM Journal on Computing, 11(2):298–313, 1982.
 
 """
 
+import sys
 import json
+import hashlib
 from itertools import groupby
+import numpy as np
 import networkx as nx
 from networkx.readwrite import json_graph
 
 
+# The codes computed by node_code() are integers modulo CODE_MODULUS.
+CODE_MODULUS = 2 ** 127 - 1
+CODE_BASE = 106180383095276624621034787405709630173
+
+
 class DAG(nx.MultiDiGraph):
     """Two Terminal Series Parallel Directed Acyclic Graph."""
 
@@ -81,57 +89,14 @@ class DAG(nx.MultiDiGraph):
                 in grouped_edges]
 
 
-class DecompositionTree(nx.DiGraph):
-    """DecompositionTree is an nx.Graph with methods for adding P-nodes and S-nodes."""
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.root = None
-
-    def _new_label(self, name):
-        """Return a string based on label for valid use as a node label.
-
-        Use to avoid repeated node labels.
-
-        """
-        if name not in self.nodes():
-            return name
+class DecompositionMixin(object):
+    """Series and parallel reductions that build the decomposition tree of a DAG.
 
-        label_fmt = '{}-{}'
-        count = 1
-        label = label_fmt.format(name, count)
+    Classes that use it define how the nodes of the tree are made, with
+    _new_leaf_node(), _new_pnode() and _new_snode(), and keep the last node
+    made in root.
 
-        while label in self.nodes():
-            count += 1
-            label = label_fmt.format(name, count)
-
-        return label
-
-    def _new_leaf_node(self, source, target):
-        """Make new leaf node representing a link between source and target in the original DAG."""
-        label = self._new_label('({}, {})'.format(source, target))
-        self.add_node(label)
-        return label
-
-    def _new_pnode(self, node1, node2):
-        """Merge node1, node2 with a P-node."""
-        label = self._new_label('P')
-        self.add_node(label)
-        self.root = label
-        self.add_edge(label, node1)
-        self.add_edge(label, node2)
-
-        return label
-
-    def _new_snode(self, node1, node2):
-        """Merge node1, node2 with an S-node."""
-        label = self._new_label('S')
-        self.add_node(label)
-        self.root = label
-        self.add_edge(label, node1)
-        self.add_edge(label, node2)
-
-        return label
+    """
 
     def add_pnode(self, source, target, label1=None, label2=None):
         """Merge two parallel nodes between source and target.
@@ -227,15 +192,105 @@ class DecompositionTree(nx.DiGraph):
         snode = self.add_snode(parent, node, child, label1, label2)
         dag.add_edge(parent, child, decomposition_node=snode)
 
+    def bulk_reduce(self, dag):
+        """Perform all parallel and series reductions that can be done in bulk.
+
+        Every bundle of parallel edges is merged into a single P-node, and
+        every maximal chain of nodes with one parent and one child is merged
+        into a single S-node, until neither is possible.  The work is done on
+        integer arrays, and dag is only modified once at the end.  dag must be
+        acyclic, or the chains would never end.
+
+        """
+        nodes = dag.nodes()
+        index = {node: i for i, node in enumerate(nodes)}
+        edges = dag.edges(data=True)
+        src = np.array([index[e[0]] for e in edges], dtype=np.int64)
+        tgt = np.array([index[e[1]] for e in edges], dtype=np.int64)
+        labels = [e[2].get('decomposition_node') for e in edges]
+        removed = []
+
+        def label(i):
+            return labels[i] or self._new_leaf_node(nodes[src[i]], nodes[tgt[i]])
+
+        while len(src) > 1:
+            # Parallel reductions: sort the edges by (src, tgt) and merge each
+            # run of equal pairs.
+            order = np.lexsort((tgt, src))
+            src, tgt = src[order], tgt[order]
+            labels = [labels[i] for i in order.tolist()]
+
+            first = np.ones(len(src), dtype=bool)
+            first[1:] = (src[1:] != src[:-1]) | (tgt[1:] != tgt[:-1])
+            starts = np.flatnonzero(first)
+            ends = np.append(starts[1:], len(src))
+            bundles = np.flatnonzero(ends - starts > 1)
+            for start, end in zip(starts[bundles].tolist(), ends[bundles].tolist()):
+                labels[start] = self._new_pnode(*(label(i) for i in range(start, end)))
+
+            src, tgt = src[starts], tgt[starts]
+            labels = [labels[i] for i in starts.tolist()]
+
+            # Series reductions: a node lies inside a chain when it has one
+            # parent and one child.  Each edge points to the previous edge in
+            # its chain, and pointer jumping finds the first edge of the chain
+            # and the position of the edge in it.
+            inner = ((np.bincount(tgt, minlength=len(nodes)) == 1) &
+                     (np.bincount(src, minlength=len(nodes)) == 1))
+            if not bundles.size and not inner.any():
+                break
+
+            edge_ids = np.arange(len(src))
+            in_edge = np.zeros(len(nodes), dtype=np.int64)
+            in_edge[tgt] = edge_ids
+            prev = np.where(inner[src], in_edge[src], edge_ids)
+            rank = (prev != edge_ids).astype(np.int64)
+            while (prev[prev] != prev).any():
+                rank += rank[prev]
+                prev = prev[prev]
+
+            order = np.lexsort((rank, prev))
+            heads, starts, sizes = np.unique(prev[order], return_index=True,
+                                             return_counts=True)
+            keep = sizes == 1
+            chains = np.flatnonzero(~keep)
+            new_src = np.concatenate((src[heads[keep]], src[heads[chains]]))
+            last = order[starts[chains] + sizes[chains] - 1]
+            new_tgt = np.concatenate((tgt[heads[keep]], tgt[last]))
+
+            new_labels = [labels[i] for i in heads[keep].tolist()]
+            for start, size in zip(starts[chains].tolist(), sizes[chains].tolist()):
+                chain = order[start:start + size].tolist()
+                new_labels.append(self._new_snode(*(label(i) for i in chain)))
+
+            removed.extend(np.flatnonzero(inner).tolist())
+            src, tgt, labels = new_src, new_tgt, new_labels
+
+        if not removed and len(labels) == len(edges):
+            return
+
+        dag.remove_nodes_from(nodes[i] for i in removed)
+        dag.remove_edges_from(dag.edges(keys=True))
+        dag.add_edges_from(
+            (nodes[s], nodes[t], {'decomposition_node': l} if l else {})
+            for s, t, l in zip(src.tolist(), tgt.tolist(), labels))
+
     def decompose(self, dag):
         """Return the decomposition tree of the DAG."""
+        source = dag.get_source()
+        sink = dag.get_sink()
+        # print('Source: {}, sink: {}'.format(source, sink))
+        assert nx.is_directed_acyclic_graph(dag), 'Not a DAG.'
+
+        # Most of the reductions can be done in bulk before the worklist
+        # algorithm below, which then only has to deal with what is left.
+        # They never remove the source or the sink.
+        self.bulk_reduce(dag)  # modifies dag!
+
         # The TTSP recognition algorithm, from the referenced source.
 
         # We maintain a list of vertices that initially includes all vertices
         # except the source and the sink.
-        source = dag.get_source()
-        sink = dag.get_sink()
-        # print('Source: {}, sink: {}'.format(source, sink))
         to_visit = list(set(dag.nodes()).difference({source, sink}))
         # to_visit = list(set(dag.neighbors(source)).difference(sink))
         # print('to visit: {}'.format(to_visit))
@@ -288,6 +343,13 @@ class DecompositionTree(nx.DiGraph):
         # between them.
         # parallel_reduce(dag, sink)
 
+        # A DAG made of a single edge needs no reductions, and its tree is a
+        # single leaf.
+        if self.root is None and dag.number_of_edges() == 1:
+            source, sink, data = dag.edges(data=True)[0]
+            if 'decomposition_node' not in data:
+                self.root = self._new_leaf_node(source, sink)
+
         # The unsatisfied list becomes empty, either because all vertices
         # (except source and sink) have been deleted by series reductions or
         # because every remaining vertex has two distinct in-neighbors or two
@@ -295,10 +357,65 @@ class DecompositionTree(nx.DiGraph):
         # second it is not.
         # print('Remaining edges in  dag: {}'.format(dag.edges()))
 
+
+class DecompositionTree(DecompositionMixin, nx.DiGraph):
+    """DecompositionTree is an nx.Graph with methods for adding P-nodes and S-nodes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.root = None
+        # name: first suffix worth trying for the next label based on name.
+        self._label_counts = {}
+
+    def _new_label(self, name):
+        """Return a string based on label for valid use as a node label.
+
+        Use to avoid repeated node labels.
+
+        """
+        label_fmt = '{}-{}'
+        count = self._label_counts.get(name, 0)
+        label = name if count == 0 else label_fmt.format(name, count)
+
+        while label in self:
+            count += 1
+            label = label_fmt.format(name, count)
+
+        self._label_counts[name] = count + 1
+        return label
+
+    def _new_leaf_node(self, source, target):
+        """Make new leaf node representing a link between source and target in the original DAG."""
+        label = self._new_label('({}, {})'.format(source, target))
+        self.add_node(label)
+        return label
+
+    def _new_pnode(self, *nodes):
+        """Merge nodes with a P-node."""
+        label = self._new_label('P')
+        self.add_node(label)
+        self.root = label
+        self.add_edges_from((label, node) for node in nodes)
+
+        return label
+
+    def _new_snode(self, *nodes):
+        """Merge nodes with an S-node."""
+        label = self._new_label('S')
+        self.add_node(label)
+        self.root = label
+        self.add_edges_from((label, node) for node in nodes)
+
+        return label
+
     def is_pnode(self, node):
         """Return whether or not node is a P-node."""
         return node.startswith('P')
 
+    def is_snode(self, node):
+        """Return whether or not node is an S-node."""
+        return node.startswith('S')
+
     def merge_pnodes(self):
         """Collapse each P-node into one."""
         self._merge_pnodes_from(self.root)
@@ -323,9 +440,400 @@ class DecompositionTree(nx.DiGraph):
                 self.remove_edge(node, child_pnode)
                 self.remove_node(child_pnode)
 
+    def node_kind(self, node):
+        """Return 'L' if node is a leaf, 'P' if it is a P-node and 'S' if it is an S-node."""
+        if not self.successors(node):
+            return 'L'
+        return 'S' if self.is_snode(node) else 'P'
+
+    def canonical_form(self):
+        """Return a string that is equal for isomorphic TTSP DAGs.
+
+        See SharedDecompositionTree.canonical_form().  The result does not
+        depend on the order in which decompose() performed the reductions,
+        nor on whether merge_pnodes() has been called.
+
+        """
+        shared = SharedDecompositionTree()
+        return shared.canonical_form(shared.add_tree(self))
+
+    def canonical_hash(self):
+        """Return a fixed-length fingerprint that is equal for isomorphic TTSP DAGs.
+
+        See SharedDecompositionTree.canonical_hash().
+
+        """
+        shared = SharedDecompositionTree()
+        return shared.canonical_hash(shared.add_tree(self))
+
+
+class SharedDecompositionTree(DecompositionMixin):
+    """Decomposition tree where identical subtrees are stored only once.
+
+    Every distinct shape of subtree is hash-consed into a single entry of the
+    form (kind, children), where kind is 'L' for leaves, 'P' or 'S', and
+    children is a tuple of entry indices.  The children of P-nodes are sorted
+    and nested nodes of the same type are spliced into their parent, so that
+    all occurrences of the same gadget share one entry.
+
+    The vertices of the DAG are kept apart from the entries.  Each node is a
+    tuple (entry, source, target, first, last, parts), where source and
+    target are the terminals of the subgraph it stands for.  The vertices
+    inside that subgraph are linked in _next from first to last, in the
+    order in which expand() visits them, and each vertex of the DAG is
+    linked once, so only this flat sequence grows with the occurrences of
+    the gadgets.  P-nodes keep their children in parts instead, until they
+    become a child of an S-node.
+
+    It is not a graph: decompose() hash-conses the nodes as the reductions
+    create them, and expand() or write_json() give the full tree.
+
+    """
+
+    def __init__(self):
+        self.root = None
+        self.entries = []
+        self._index = {}
+        self._next = {}
+
+    def add(self, kind, children=()):
+        """Return the index of the entry (kind, children), adding it if needed."""
+        children = tuple(sorted(children) if kind == 'P' else children)
+        key = (kind, children)
+        if key not in self._index:
+            self._index[key] = len(self.entries)
+            self.entries.append(key)
+
+        return self._index[key]
+
+    def add_tree(self, tree):
+        """Add the subtrees of a DecompositionTree and return the entry of its root.
+
+        Return None if the tree is empty.
+
+        """
+        if tree.root is None:
+            return
+
+        # Each node whose parent has a different type collects the nodes
+        # below it, looking through the nodes of its own type.  Every node is
+        # looked at once this way.
+        entries = {}
+        for node in nx.dfs_postorder_nodes(tree, tree.root):
+            kind = tree.node_kind(node)
+            parents = tree.predecessors(node)
+            if kind != 'L' and parents and tree.node_kind(parents[0]) == kind:
+                continue
+
+            children = []
+            stack = tree.successors(node)[::-1]
+            while stack:
+                child = stack.pop()
+                if tree.node_kind(child) == kind:
+                    stack.extend(tree.successors(child)[::-1])
+                else:
+                    children.append(entries.pop(child))
+
+            entries[node] = self.add(kind, children)
+
+        return entries[tree.root]
+
+    def _new_leaf_node(self, source, target):
+        return self.add('L'), source, target, None, None, ()
+
+    def _new_pnode(self, *nodes):
+        """Merge nodes with a P-node."""
+        parts = []
+        for node in nodes:
+            parts.extend(node[5] or [node])
+        parts.sort(key=lambda part: part[0])
+
+        entry = self.add('P', [part[0] for part in parts])
+        self.root = (entry, nodes[0][1], nodes[0][2], None, None, tuple(parts))
+        return self.root
+
+    def _new_snode(self, *nodes):
+        """Merge nodes with an S-node."""
+        children = []
+        segments = []
+        for node in nodes:
+            entry = node[0]
+            if self.entries[entry][0] == 'S':
+                children.extend(self.entries[entry][1])
+            else:
+                children.append(entry)
+
+            if segments:
+                segments.append((node[1], node[1]))
+            segments.append(self._segment(node))
+
+        first, last = self._chain(segments)
+        self.root = (self.add('S', children), nodes[0][1], nodes[-1][2],
+                     first, last, ())
+        return self.root
+
+    def _segment(self, node):
+        """Return the first and last vertices inside node."""
+        _, _, _, first, last, parts = node
+        if parts:
+            return self._chain(self._segment(part) for part in parts)
+        return first, last
+
+    def _chain(self, segments):
+        """Link (first, last) segments of vertices in order, and return the result."""
+        first = last = None
+        for segment_first, segment_last in segments:
+            if segment_first is None:
+                continue
+            if last is None:
+                first = segment_first
+            else:
+                self._next[last] = segment_first
+            last = segment_last
+
+        return first, last
+
+    def canonical_form(self, entry=None):
+        """Return a string that is equal for isomorphic TTSP DAGs.
+
+        The string describes the subtree of entry, or the whole tree by
+        default.  Entries are renumbered one height at a time, as in the AHU tree
+        isomorphism algorithm: all entries of the same height are given
+        consecutive ids in the order of their (kind, children ids) pairs,
+        where the ids of the children of P-nodes are sorted.  The result
+        lists these pairs in id order, so it is linear in the number of
+        distinct entries reachable from the root.
+
+        """
+        if entry is None and self.root is None:
+            return ''
+
+        root = self.root[0] if entry is None else entry
+        reachable = {root}
+        stack = [root]
+        while stack:
+            for child in self.entries[stack.pop()][1]:
+                if child not in reachable:
+                    reachable.add(child)
+                    stack.append(child)
+
+        # Children are always added before their parents.
+        heights = {}
+        levels = {}
+        for entry in sorted(reachable):
+            children = self.entries[entry][1]
+            heights[entry] = 1 + max((heights[c] for c in children), default=0)
+            levels.setdefault(heights[entry], []).append(entry)
+
+        ids = {}
+        table = []
+        for height in sorted(levels):
+            keys = {}
+            for entry in levels[height]:
+                kind, children = self.entries[entry]
+                children = [ids[c] for c in children]
+                if kind == 'P':
+                    children.sort()
+                keys[entry] = (kind, tuple(children))
+
+            first = len(table)
+            table.extend(sorted(set(keys.values())))
+            position = {key: first + i for i, key in enumerate(table[first:])}
+            ids.update((entry, position[key]) for entry, key in keys.items())
+
+        return ';'.join('{}({})'.format(kind, ','.join(map(str, children)))
+                        for kind, children in table)
+
+    def canonical_hash(self, entry=None):
+        """Return a fixed-length fingerprint that is equal for isomorphic TTSP DAGs.
+
+        The fingerprint is that of the subtree of entry, or of the whole tree
+        by default.  The code of every entry is given by node_code(), so that
+        it can also be computed in streaming, as in external_decomposition.py.
+        Return None if the tree is empty.
+
+        """
+        if entry is None and self.root is None:
+            return
+
+        codes = []
+        for kind, children in self.entries:
+            codes.append(node_code(kind, ((codes[c], CODE_BASE) for c in children)))
+        return code_hash(codes[self.root[0] if entry is None else entry])
+
+    def _sizes(self):
+        """Return the number of vertices inside the subtree of every entry."""
+        sizes = []
+        for kind, children in self.entries:
+            inner = len(children) - 1 if kind == 'S' else 0
+            sizes.append(inner + sum(sizes[c] for c in children))
+        return sizes
+
+    def _vertices(self):
+        """Return the vertices inside the root, in the order of expand()."""
+        first, last = self._segment(self.root)
+        if first is None:
+            return []
+
+        vertices = [first]
+        while vertices[-1] != last:
+            vertices.append(self._next[vertices[-1]])
+        return vertices
+
+    def _children(self, node, vertices, sizes):
+        """Yield the children of a node of expand(), as (entry, source, target, position)."""
+        entry, source, target, position = node
+        kind, children = self.entries[entry]
+        for i, child in enumerate(children):
+            end = position + sizes[child]
+            if kind == 'S':
+                child_target = vertices[end] if i < len(children) - 1 else target
+                yield child, source, child_target, position
+                source, position = child_target, end + 1
+            else:
+                yield child, source, target, position
+                position = end
+
+    def _label(self, node, counts):
+        """Return the next label for node in expand()."""
+        entry, source, target = node[:3]
+        kind = self.entries[entry][0]
+        name = '({}, {})'.format(source, target) if kind == 'L' else kind
+        count = counts.get(name, 0)
+        counts[name] = count + 1
+        return name if count == 0 else '{}-{}'.format(name, count)
+
+    def expand(self):
+        """Yield (label, children) for every node of the full tree, in post-order.
+
+        children are the positions of the children of the node in this
+        sequence.  Labels follow the scheme of DecompositionTree, and leaves
+        are labelled after the edges of the DAG they stand for.
+
+        """
+        if self.root is None:
+            return
+
+        vertices = self._vertices()
+        sizes = self._sizes()
+        counts = {}
+        index = 0
+        root = self.root[:3] + (0,)
+        stack = [(root, self._children(root, vertices, sizes), [])]
+        while stack:
+            node, children, indices = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append((child, self._children(child, vertices, sizes), []))
+                continue
+
+            stack.pop()
+            yield self._label(node, counts), indices
+
+            if stack:
+                stack[-1][2].append(index)
+            index += 1
+
+    def root_label(self):
+        """Return the label that expand() gives to the root."""
+        if self.root is None:
+            return
+
+        # The root comes last, so its label is given by the number of nodes
+        # of its kind in the whole tree.
+        entry = self.root[0]
+        kind = self.entries[entry][0]
+        if kind == 'L':
+            return self._label(self.root, {})
+
+        totals = []
+        for entry_kind, children in self.entries:
+            totals.append((entry_kind == kind) + sum(totals[c] for c in children))
+        return self._label(self.root, {kind: totals[entry] - 1})
+
+    def write_json(self, outfile):
+        """Write the full tree in the format of public/tree.json."""
+        write_tree((label for label, _ in self.expand()),
+                   ((index, child) for index, (_, children)
+                    in enumerate(self.expand()) for child in children),
+                   outfile, self.root_label(), self.canonical_hash())
+
+
+def combine_codes(kind, parts):
+    """Combine the parts that the children of a node of the given kind contribute.
+
+    A child contributes (code, CODE_BASE), where code is its node_code(), or
+    the combined parts of its own children if it has the same kind as the
+    node.  The parts of an S-node are combined as the digits of a number in
+    base CODE_BASE, and those of a P-node are added up, so that splicing
+    nested nodes of the same type does not change the result, and neither
+    does the order of the children of a P-node.
+
+    <returns> a (value, scale) pair, where scale is CODE_BASE to the number of
+    children.
+
+    """
+    value, scale = 0, 1
+    for part_value, part_scale in parts:
+        if kind == 'S':
+            value = value * part_scale + part_value
+        else:
+            value = value + part_value
+        value, scale = value % CODE_MODULUS, scale * part_scale % CODE_MODULUS
+
+    return value, scale
+
+
+def node_code(kind, parts=()):
+    """Return the code of a node of the given kind, given the parts of its children."""
+    digest = hashlib.sha1('{}{}'.format(kind, combine_codes(kind, parts))
+                          .encode('utf-8')).digest()
+    return int.from_bytes(digest, 'big') % CODE_MODULUS
+
+
+def code_hash(code):
+    """Return the fingerprint of the tree whose root has the given code."""
+    return '{:032x}'.format(code)
+
+
+def write_tree(nodes, links, outfile, root, canonical=None):
+    """Write a decomposition tree in node-link format, one node at a time.
+
+    <nodes> an iterable of node labels.
+
+    <links> an iterable of (parent, child) pairs of positions in nodes.
+
+    <root> the label of the root, or None if the tree is empty.
+
+    <canonical> the canonical hash of the tree, if known.
+
+    """
+    outfile.write('{"directed": true, "multigraph": false, "graph": {},\n')
+
+    outfile.write(' "nodes": [')
+    for index, label in enumerate(nodes):
+        outfile.write(',\n  ' if index else '\n  ')
+        outfile.write(json.dumps({'id': label}))
+    outfile.write('\n ],\n')
+
+    outfile.write(' "links": [')
+    for index, (source, target) in enumerate(links):
+        outfile.write(',\n  ' if index else '\n  ')
+        outfile.write(json.dumps({'source': source, 'target': target}))
+    outfile.write('\n ],\n')
+
+    if canonical is not None:
+        outfile.write(' "canonical": {},\n'.format(json.dumps(canonical)))
+    outfile.write(' "root": {}}}\n'.format(json.dumps(root)))
+
 
 def main():
-    """Read a DAG from stdin, and decompose it if possible."""
+    """Read a DAG from stdin, and decompose it if possible.
+
+    With --shared, build a SharedDecompositionTree and stream its expansion
+    to public/tree.json.
+
+    """
     dag = DAG.read_dag()
 
     jsondata = json_graph.node_link_data(dag)
@@ -336,12 +844,20 @@ def main():
             link['target'] = jsondata['nodes'][link['target']]['id']
         json.dump(jsondata, outfile, indent=4)
 
+    if '--shared' in sys.argv[1:]:
+        tree = SharedDecompositionTree()
+        tree.decompose(dag)
+        with open('public/tree.json', 'w') as outfile:
+            tree.write_json(outfile)
+        return
+
     tree = DecompositionTree()
     tree.decompose(dag)
     tree.merge_pnodes()
 
     jsondata = json_graph.node_link_data(tree)
     jsondata['root'] = tree.root
+    jsondata['canonical'] = tree.canonical_hash()
     with open('public/tree.json', 'w') as outfile:
         json.dump(jsondata, outfile, indent=4)
 
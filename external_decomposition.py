@@ -0,0 +1,556 @@
+"""
+external_decomposition.py
+-------------------------
+
+Decomposing a TTSP DAG that does not fit in memory.
+
+The edges are kept on disk in sorted runs of at most max_edges records.
+Parallel reductions (repeated source/target pairs) and series reductions
+(nodes with a single in-edge and a single out-edge) are applied in
+streaming passes over these runs until the remaining graph has at most
+max_edges edges.  The remaining graph is then handed to
+DecompositionTree.decompose(), and its subtree is spliced with the partial
+subtrees written during the streaming passes into a single tree file.
+Its canonical hash is computed in a last streaming pass.  Every step holds
+at most max_edges records in memory at a time, so that memory use does not
+grow with the size of the DAG.
+
+Every edge record on disk is a line of the form
+
+    source<TAB>target<TAB>index<TAB>label
+
+where index and label identify the node of the decomposition tree that
+stands for the edge.  The decomposition tree itself is written as it grows:
+the label of every node goes to one file, so that the index of a node is its
+line number there, and every link goes to another file as a line of the form
+
+    parent<TAB>child<TAB>parent_kind<TAB>child_kind
+
+where the kinds are 'L', 'P' or 'S'.  The children of a node are linked in
+order, and always before the node itself is linked to its parent.
+
+"""
+
+import os
+import sys
+import heapq
+import hashlib
+import tempfile
+from itertools import chain, groupby, islice
+import networkx as nx
+
+from decomposition import (DAG, DecompositionTree, CODE_BASE, combine_codes,
+                           node_code, code_hash, write_tree)
+
+
+DEFAULT_MAX_EDGES = 1000000
+
+# Maximum number of sorted runs that are merged at the same time, each of
+# them with an open file.
+FAN_IN = 64
+
+
+def _kind(label):
+    """Return 'P' or 'S' if label is that of a P-node or an S-node, or 'L' otherwise."""
+    return label[0] if label[0] in 'PS' else 'L'
+
+
+class _Records(object):
+    """Append-only on-disk storage for the nodes of a decomposition tree."""
+
+    def __init__(self, workdir):
+        self.labels_path = os.path.join(workdir, 'tree.labels')
+        self.links_path = os.path.join(workdir, 'tree.links')
+        self.size = 0
+        self.counts = {}
+        self._labels = open(self.labels_path, 'w')
+        self._links = open(self.links_path, 'w')
+
+    def new_label(self, name):
+        """Return a string based on name for valid use as a node label.
+
+        Follows the same scheme as DecompositionTree._new_label(), without
+        having to keep all labels in memory.
+
+        """
+        count = self.counts.get(name, 0)
+        self.counts[name] = count + 1
+        return name if count == 0 else '{}-{}'.format(name, count)
+
+    def add(self, label):
+        """Write a node and return its index."""
+        self._labels.write(label + '\n')
+        self.size += 1
+        return self.size - 1
+
+    def link(self, parent, child, parent_label, child_label):
+        """Make the node with index child the next child of the node with index parent."""
+        self._links.write(_format((parent, child, _kind(parent_label),
+                                   _kind(child_label))))
+
+    def close(self):
+        self._labels.close()
+        self._links.close()
+
+    def labels(self):
+        """Yield the label of every node, in index order."""
+        with open(self.labels_path) as infile:
+            for line in infile:
+                yield line.rstrip('\n')
+
+    def links(self):
+        """Yield (parent, child, parent_kind, child_kind) for every link, in order."""
+        return _read_run(self.links_path, _parse_link)
+
+
+class _SplicedTree(DecompositionTree):
+    """DecompositionTree whose labels do not clash with those already on disk."""
+
+    def __init__(self, records, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.records = records
+
+    def _new_label(self, name):
+        return self.records.new_label(name)
+
+
+def _format(record):
+    return '\t'.join(map(str, record)) + '\n'
+
+
+def _parse_edge(fields):
+    source, target, index, label = fields
+    return source, target, int(index), label
+
+
+def _parse_link(fields):
+    parent, child, parent_kind, child_kind = fields
+    return int(parent), int(child), parent_kind, child_kind
+
+
+def _parse_ints(fields):
+    return tuple(int(field) for field in fields)
+
+
+def _write_edge(outfile, edge):
+    outfile.write(_format(edge))
+
+
+def _read_edges(path):
+    """Yield the edge records (source, target, index, label) stored in path."""
+    return _read_run(path, _parse_edge)
+
+
+def _write_run(records, workdir):
+    """Write records to a new temporary file and return its path."""
+    fd, path = tempfile.mkstemp(dir=workdir, suffix='.run')
+    with os.fdopen(fd, 'w') as outfile:
+        for record in records:
+            outfile.write(_format(record))
+    return path
+
+
+def _read_run(path, parse):
+    """Yield the records stored in path, parsed by parse."""
+    with open(path) as infile:
+        for line in infile:
+            yield parse(line.rstrip('\n').split('\t'))
+
+
+def _merge_runs(runs, key, parse, workdir):
+    """Merge the sorted runs into a new one, remove them and return its path."""
+    path = _write_run(heapq.merge(*(_read_run(r, parse) for r in runs), key=key),
+                      workdir)
+    for run in runs:
+        os.remove(run)
+    return path
+
+
+def _external_sort(records, key, max_edges, workdir, parse=_parse_edge):
+    """Yield records sorted by key, holding at most max_edges of them in memory.
+
+    Sorted runs are merged FAN_IN at a time until no more than FAN_IN are
+    left, so that the number of open files does not grow with the input.
+
+    """
+    runs = []
+    for chunk in iter(lambda: list(islice(records, max_edges)), []):
+        chunk.sort(key=key)
+        runs.append(_write_run(chunk, workdir))
+
+    while len(runs) > FAN_IN:
+        runs = [_merge_runs(runs[i:i + FAN_IN], key, parse, workdir)
+                for i in range(0, len(runs), FAN_IN)]
+
+    try:
+        yield from heapq.merge(*(_read_run(r, parse) for r in runs), key=key)
+    finally:
+        for path in runs:
+            os.remove(path)
+
+
+class _Messages(object):
+    """Priority queue of messages that spills to disk.
+
+    Messages are tuples of integers that start with (time, line).
+
+    At most max_items messages are held in memory, and the rest in at most
+    FAN_IN sorted runs.
+
+    """
+
+    def __init__(self, max_items, workdir):
+        self.max_items = max_items
+        self.workdir = workdir
+        self._heap = []
+        # A (first message, remaining messages, path) triple per run.
+        self._runs = []
+
+    def push(self, message):
+        heapq.heappush(self._heap, message)
+        if len(self._heap) >= self.max_items:
+            self._spill()
+
+    def _spill(self):
+        """Move the messages in memory to a new run, merging the runs if needed."""
+        runs = [sorted(self._heap)]
+        self._heap = []
+        if len(self._runs) >= FAN_IN:
+            runs.extend(chain([first], rest) for first, rest, _ in self._runs)
+            paths = [path for _, _, path in self._runs]
+            self._runs = []
+        else:
+            paths = []
+
+        path = _write_run(heapq.merge(*runs), self.workdir)
+        for old in paths:
+            os.remove(old)
+        self._push_run(_read_run(path, _parse_ints), path)
+
+    def _push_run(self, rest, path):
+        first = next(rest, None)
+        if first is None:
+            os.remove(path)
+        else:
+            heapq.heappush(self._runs, (first, rest, path))
+
+    def pop(self, time):
+        """Yield the messages with the given time, in order."""
+        while True:
+            if self._runs and (not self._heap or self._runs[0][0] < self._heap[0]):
+                if self._runs[0][0][0] != time:
+                    return
+                message, rest, path = heapq.heappop(self._runs)
+                self._push_run(rest, path)
+                yield message
+            elif self._heap and self._heap[0][0] == time:
+                yield heapq.heappop(self._heap)
+            else:
+                return
+
+
+def _coin(node, rnd):
+    """Return a pseudo-random bit for node that changes with every round."""
+    return hashlib.md5('{}:{}'.format(rnd, node).encode('utf-8')).digest()[0] & 1
+
+
+def _read_input(lines, records, outfile, max_edges, workdir):
+    """Read the edgelist, create a leaf for every edge and merge multi-edges.
+
+    Return the number of edges written to outfile.
+
+    """
+    num_edges = int(next(lines))
+    edges = (tuple(next(lines).split()) for _ in range(num_edges))
+
+    written = 0
+    for (source, target), group in groupby(_external_sort(
+            ((s, t, 0, '') for s, t in edges), lambda e: e[:2],
+            max_edges, workdir), key=lambda e: e[:2]):
+
+        leaf = '({}, {})'.format(source, target)
+        label, index = leaf, records.add(leaf)
+        for i, _ in enumerate(group):
+            if i == 1:
+                first = index
+                label = records.new_label('P')
+                index = records.add(label)
+                records.link(index, first, label, leaf)
+            if i >= 1:
+                records.link(index, records.add('{}-{}'.format(leaf, i)),
+                             label, leaf)
+
+        _write_edge(outfile, (source, target, index, label))
+        written += 1
+
+    return written
+
+
+def _parallel_pass(path, outfile, records, max_edges, workdir):
+    """Merge every bundle of parallel edges into a single n-ary P-node.
+
+    If one of the edges of a bundle already stands for a P-node, the others
+    become children of that P-node, so that P-nodes are never nested.
+
+    Return the number of edges written to outfile.
+
+    """
+    written = 0
+    for (source, target), group in groupby(
+            _external_sort(_read_edges(path),
+                           lambda e: (e[0], e[1], _kind(e[3]) != 'P'),
+                           max_edges, workdir),
+            key=lambda e: e[:2]):
+        edge = next(group)
+        for other in group:
+            if _kind(edge[3]) != 'P':
+                label = records.new_label('P')
+                index = records.add(label)
+                records.link(index, edge[2], label, edge[3])
+                edge = (source, target, index, label)
+            records.link(edge[2], other[2], edge[3], other[3])
+
+        _write_edge(outfile, edge)
+        written += 1
+
+    return written
+
+
+def _series_pass(path, outfile, records, rnd, max_edges, workdir):
+    """Contract nodes with a single in-edge and a single out-edge.
+
+    To be able to decide locally which nodes to contract, a node v with
+    edges (u, v) and (v, w) is only contracted when _coin(v) is 1 and
+    _coin(w) is 0.  This guarantees that no two contracted nodes are
+    adjacent, so that every edge takes part in at most one contraction.
+    Repeated passes (with new coins) contract whole chains.
+
+    Return the number of edges written to outfile, and the number of nodes
+    that could have been contracted in this pass.
+
+    """
+    by_target = groupby(_external_sort(_read_edges(path), lambda e: e[1],
+                                       max_edges, workdir),
+                        key=lambda e: e[1])
+    by_source = groupby(_external_sort(_read_edges(path), lambda e: e[0],
+                                       max_edges, workdir),
+                        key=lambda e: e[0])
+
+    # Merge-join the in-edges and out-edges of each node.  Nodes without
+    # in-edges (the source) or out-edges (the sink) are never contracted.
+    # The edges consumed by a contraction are set aside on disk.
+    fd, consumed_path = tempfile.mkstemp(dir=workdir, suffix='.consumed')
+    contractible = 0
+    written = 0
+    with os.fdopen(fd, 'w') as consumed:
+        node_out, out_edges = next(by_source, (None, None))
+        for node, in_edges in by_target:
+            while node_out is not None and node_out < node:
+                node_out, out_edges = next(by_source, (None, None))
+            if node_out != node:
+                continue
+
+            in_edges = [e for _, e in zip(range(2), in_edges)]
+            out_edges = [e for _, e in zip(range(2), out_edges)]
+            if len(in_edges) != 1 or len(out_edges) != 1:
+                continue
+
+            contractible += 1
+            in_edge, out_edge = in_edges[0], out_edges[0]
+            if not _coin(node, rnd) or _coin(out_edge[1], rnd):
+                continue
+
+            label = records.new_label('S')
+            index = records.add(label)
+            records.link(index, in_edge[2], label, in_edge[3])
+            records.link(index, out_edge[2], label, out_edge[3])
+            _write_edge(outfile, (in_edge[0], out_edge[1], index, label))
+            _write_edge(consumed, in_edge)
+            _write_edge(consumed, out_edge)
+            written += 1
+
+    # Copy every edge that was not consumed, matching them by index.
+    consumed = (e[2] for e in _external_sort(
+        _read_edges(consumed_path), lambda e: e[2], max_edges, workdir))
+    next_consumed = next(consumed, None)
+    for edge in _external_sort(_read_edges(path), lambda e: e[2],
+                               max_edges, workdir):
+        while next_consumed is not None and next_consumed < edge[2]:
+            next_consumed = next(consumed, None)
+        if next_consumed != edge[2]:
+            _write_edge(outfile, edge)
+            written += 1
+
+    os.remove(consumed_path)
+    return written, contractible
+
+
+def _decompose_in_memory(path, records):
+    """Decompose the edges stored in path and splice the result into records.
+
+    Return the label of the root of the full decomposition tree, or None if
+    the DAG is not a TTSP.
+
+    """
+    dag = DAG()
+    indices = {}
+    for source, target, index, label in _read_edges(path):
+        dag.add_edge(source, target, decomposition_node=label)
+        indices[label] = index
+
+    tree = _SplicedTree(records)
+    tree.decompose(dag)
+    if dag.number_of_edges() != 1:
+        return
+
+    if tree.root is None:
+        return dag.edges(data=True)[0][2]['decomposition_node']
+
+    # Write the new nodes in post-order, after those already on disk.  P-nodes
+    # are collapsed into their P-node parents as in merge_pnodes(), and into
+    # the P-node already on disk among their children, if any.
+    labels = {label: label for label in indices}
+    for node in nx.dfs_postorder_nodes(tree, tree.root):
+        if node in indices:
+            continue
+
+        parents = tree.predecessors(node)
+        if tree.is_pnode(node) and parents and tree.is_pnode(parents[0]):
+            continue
+
+        children = []
+        stack = tree.successors(node)[::-1]
+        while stack:
+            child = stack.pop()
+            if tree.is_pnode(node) and tree.is_pnode(child) and child not in indices:
+                stack.extend(tree.successors(child)[::-1])
+            else:
+                children.append(child)
+
+        hosts = [c for c in children if c in indices and tree.is_pnode(c)]
+        if tree.is_pnode(node) and hosts:
+            label = hosts[0]
+            children.remove(label)
+        else:
+            label = node
+            indices[label] = records.add(label)
+
+        for child in children:
+            records.link(indices[label], indices[child], label, labels[child])
+        indices[node] = indices[label]
+        labels[node] = label
+
+    return labels[tree.root]
+
+
+def _canonical_hash(records, root, max_edges, workdir):
+    """Return the canonical_hash() of the tree in records, rooted at root.
+
+    The codes of the nodes are computed bottom-up while reading the links in
+    order.  The part that a node contributes to its parent, as defined by
+    combine_codes(), is sent as a message to the line where the parent is
+    linked in turn, so that it is received exactly when needed.  Messages
+    have a fixed size, and at most max_edges of them are held in memory.
+
+    """
+    # Join the links on their child with the links on their parent, to find
+    # the line where the parent of each link is linked in turn.  The root is
+    # never linked; its messages are sent to the end of the file.
+    end = sys.maxsize
+    by_child = _external_sort(
+        ((child, line) for line, (_, child, _, _) in enumerate(records.links())),
+        lambda r: r[0], max_edges, workdir, _parse_ints)
+    by_parent = _external_sort(
+        ((parent, line) for line, (parent, _, _, _) in enumerate(records.links())),
+        lambda r: r[0], max_edges, workdir, _parse_ints)
+
+    def join():
+        child, time = next(by_child, (None, None))
+        for parent, line in by_parent:
+            while child is not None and child < parent:
+                child, time = next(by_child, (None, None))
+            yield line, time if child == parent else end
+
+    times = (time for _, time in _external_sort(
+        join(), lambda r: r[0], max_edges, workdir, _parse_ints))
+
+    messages = _Messages(max_edges, workdir)
+    for line, ((_, _, parent_kind, kind), time) in enumerate(
+            zip(records.links(), times)):
+        parts = (message[2:] for message in messages.pop(line))
+        if kind == parent_kind:
+            part = combine_codes(kind, parts)
+        else:
+            part = node_code(kind, parts), CODE_BASE
+        messages.push((time, line) + part)
+
+    parts = (message[2:] for message in messages.pop(end))
+    return code_hash(node_code(_kind(root), parts))
+
+
+def decompose_external(lines, tree_path, max_edges=DEFAULT_MAX_EDGES,
+                       workdir=None):
+    """Decompose the DAG read from lines and write its decomposition tree.
+
+    <lines> an iterator over the lines of an edgelist, in the format read by
+    DAG.read_dag().
+
+    <tree_path> the file where the decomposition tree is written, in the
+    same format as public/tree.json.
+
+    <max_edges> the maximum number of records (edges, links or messages)
+    held in memory by each step.
+
+    <returns> the label of the root of the decomposition tree, or None if
+    the DAG is not a TTSP.
+
+    """
+    with tempfile.TemporaryDirectory(dir=workdir) as workdir:
+        records = _Records(workdir)
+        path = os.path.join(workdir, 'edges.0')
+        with open(path, 'w') as outfile:
+            num_edges = _read_input(iter(lines), records, outfile,
+                                    max_edges, workdir)
+
+        rnd = 0
+        while num_edges > max_edges:
+            rnd += 1
+            series_path = os.path.join(workdir, 'edges.s')
+            with open(series_path, 'w') as outfile:
+                series_edges, contractible = _series_pass(
+                    path, outfile, records, rnd, max_edges, workdir)
+
+            path = os.path.join(workdir, 'edges.{}'.format(rnd))
+            with open(path, 'w') as outfile:
+                num_edges = _parallel_pass(series_path, outfile, records,
+                                           max_edges, workdir)
+
+            # Every TTSP with more than one edge admits a reduction.
+            if not contractible and num_edges == series_edges:
+                print('Not a TTSP.')
+                records.close()
+                return
+
+        root = _decompose_in_memory(path, records)
+        records.close()
+        if root is None:
+            return
+
+        canonical = _canonical_hash(records, root, max_edges, workdir)
+        with open(tree_path, 'w') as outfile:
+            write_tree(records.labels(),
+                       ((parent, child) for parent, child, _, _ in records.links()),
+                       outfile, root, canonical)
+
+        return root
+
+
+def main():
+    """Read a DAG from stdin, and decompose it using at most argv[1] edges of memory."""
+    max_edges = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MAX_EDGES
+    decompose_external((line.rstrip('\n') for line in sys.stdin),
+                       'public/tree.json', max_edges)
+
+
+if __name__ == '__main__':
+    main()
@@ -255,6 +255,144 @@ def find_galls(graph):
         return
 
 
+class IncrementalGalls(object):
+    """Locate the galls of a graph whose edges arrive one at a time.
+
+    This keeps the state of Algorithm 1 up to date after every call to
+    add_edge(), instead of running it again from step 1.  In-degrees are
+    checked as edges arrive (step 2), each reticulation node starts its
+    chain walk as soon as its second parent arrives (steps 3-5), and a walk
+    that reaches a node without parents waits there until that node gets
+    one, so no chain is ever walked twice.  The galled tree and galled
+    network conditions (steps 6-9) are kept as counters over the nodes of
+    the located galls.
+
+    """
+
+    def __init__(self):
+        # node: [parent1, parent2]
+        self.parents = {}
+        # The first node found with more than two parents (step 2).
+        self.invalid = None
+        # Whether a gall contains a reticulation node other than its own.
+        self.broken = False
+        # reticulation: (left_chain, right_chain), as in find_galls().
+        self.cycles = {}
+        # reticulation: [left_nodes, right_nodes, left_set, right_set] for
+        # the chains that have not met yet.
+        self._walks = {}
+        # node: reticulations whose walk is waiting for a parent of node.
+        self._waiting = {}
+        # node: number of galls that contain node.
+        self._members = {}
+        # Number of nodes that belong to more than one gall.
+        self._shared = 0
+
+    def add_edge(self, source, target):
+        """Add the edge source -> target.  Return False if the graph can no
+        longer have galls.
+
+        """
+        if self.invalid is not None:
+            return False
+
+        self.parents.setdefault(source, [])
+        parents = self.parents.setdefault(target, [])
+        if source in parents:
+            return not self.broken
+        parents.append(source)
+
+        # 2.  If a node with more than two incoming edges is found, then
+        #     return null.
+        if len(parents) > 2:
+            self.invalid = target
+            return False
+
+        # 3.  For every reticulation node find its two parents. Each of these
+        #     parents belongs to a chain of the gall.
+        if len(parents) == 2:
+            if target in self._members:
+                self.broken = True
+            self._walks[target] = [[parents[0]], [parents[1]],
+                                   {parents[0]}, {parents[1]}]
+            self._advance(target)
+
+        else:
+            for reticulation in self._waiting.pop(target, ()):
+                if reticulation in self._walks:
+                    self._advance(reticulation)
+
+        return not self.broken
+
+    def _advance(self, reticulation):
+        """Walk up both chains of reticulation for as long as possible."""
+        # 4.  For every parent find its parent and assign it to the same
+        #     chain. (At each step discover one node from each chain.)
+        # 5.  Continue this process until a node is found which already
+        #     belongs to the other chain.
+        walk = self._walks[reticulation]
+        moved = True
+        while moved:
+            moved = False
+            for this, other in ((0, 1), (1, 0)):
+                ancestors = self.parents[walk[this][-1]]
+                if len(ancestors) != 1:
+                    continue
+
+                node = ancestors[0]
+                walk[this].append(node)
+                walk[this + 2].add(node)
+                moved = True
+                if node in walk[other + 2]:
+                    self._close(reticulation, this, node)
+                    return
+
+        # Neither chain can go further up until its top node gets a parent.
+        for chain in walk[:2]:
+            if not self.parents[chain[-1]]:
+                self._waiting.setdefault(chain[-1], set()).add(reticulation)
+
+    def _close(self, reticulation, side, beginning):
+        """Record the gall of reticulation, whose chains met at beginning."""
+        walk = self._walks.pop(reticulation)
+
+        # The other chain may have been walked past the beginning node.
+        chains = [walk[0], walk[1]]
+        other = chains[1 - side]
+        chains[1 - side] = other[:other.index(beginning) + 1]
+        self.cycles[reticulation] = (set(chains[0]), set(chains[1]))
+
+        # 6.  After locating all the galls, test the galled tree and the
+        #     galled network condition.
+        for node in {reticulation, *chains[0], *chains[1]}:
+            if node != reticulation and len(self.parents[node]) == 2:
+                self.broken = True
+            self._members[node] = self._members.get(node, 0) + 1
+            if self._members[node] == 2:
+                self._shared += 1
+
+    def galls(self):
+        """Return the galls found so far.
+
+        <returns> the galls of the graph made of all the edges added so far,
+        and a boolean value that is True for a galled tree and False for a
+        galled network.  Return None if the graph is neither, or if some
+        gall is still missing edges.  Unlike find_galls(), which walks both
+        chains in lockstep and may add to one of them the parent of the
+        beginning node, both chains here end at the beginning node.
+
+        """
+        # 7.  If the galled tree condition holds then characterize the graph
+        #     as a "galled tree".
+        # 8.  Else if the galled network condition holds then characterize
+        #     the graph as a "galled network".
+        # 9.  Else return null.
+        if self.invalid is not None or self.broken or self._walks:
+            return
+
+        return self.cycles, self._shared == 0
+
+
 def read_graph(filename):
     """Read an edgelist file and return a nx.DiGraph."""
     return nx.read_edgelist(filename, create_using=nx.DiGraph(), nodetype=str)